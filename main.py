@@ -1,24 +1,56 @@
-from datetime import date
-from flask import Flask, abort, render_template, redirect, url_for, flash
+import datetime as dt
+from datetime import date, datetime
+from flask import Flask, abort, render_template, redirect, url_for, flash, request, stream_template, make_response
+from flask.helpers import get_debug_flag
 from flask_bootstrap import Bootstrap5
+from flask_caching import Cache
 from flask_ckeditor import CKEditor
+from flask_compress import Compress
 from flask_gravatar import Gravatar
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import Integer, String, Text
-from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column, joinedload, selectinload, undefer
+from sqlalchemy import Integer, String, Text, Date, DateTime, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from functools import wraps, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
+import hashlib
+import importlib.util
+import json
 import os
+import sqlite3
+import time
 from dotenv import load_dotenv
+import click
+from jinja2 import FileSystemBytecodeCache
+from jinja2_htmlmin import minify_loader
 
 
 app = Flask(__name__)
 load_dotenv()
+
+# Minify the HTML templates once, when Jinja loads them, so every render sends the smaller output.
+app.jinja_loader = minify_loader(app.jinja_loader, remove_comments=True, remove_empty_space=True,
+                                 reduce_boolean_attributes=True)
+# Keep compiled (already minified) templates on disk so restarted workers skip compiling them again.
+jinja_cache_dir = os.path.join(app.instance_path, 'jinja_cache')
+os.makedirs(jinja_cache_dir, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(jinja_cache_dir)
+# Don't check templates for changes on every render. app.run(debug=True) turns reloading back on.
+app.jinja_env.auto_reload = False
 app.config['SECRET_KEY'] = os.environ.get('FLASK_KEY')
 ckeditor = CKEditor(app)
 Bootstrap5(app)
+# Per-process cache for rendered post fragments, see _render_post.
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
+# Compress responses with brotli, or gzip for clients that don't accept it.
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+Compress(app)
 
 # TODO: Configure Flask-Login
 # Initiate Flask Login Module
@@ -31,10 +63,31 @@ gravatar = Gravatar(app, size=100, rating='g', default='retro',
                     force_default=False, force_lower=False, use_ssl=False, base_url=None)
 
 
+# Building a gravatar URL means an md5 and string formatting per comment on every render, so cache the URL per
+# (email, size) and use that for the "gravatar" template filter instead.
+@lru_cache(maxsize=4096)
+def _gravatar_url(email, size):
+    return gravatar(email, size=size)
+
+
+@app.template_filter('gravatar')
+def gravatar_filter(email, size=None):
+    return _gravatar_url(email.lower().strip(), size)
+
+# Argon2id password hasher, created once and shared by the register and login routes.
+# Parameters can be tuned for the host: time_cost (rounds), memory_cost (KiB) and parallelism (threads).
+ph = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=2)
+
+# Worker threads for password verification. argon2-cffi and hashlib release the GIL while hashing,
+# so logins handled by different request threads (e.g. gunicorn's gthread worker) hash in parallel.
+_HASH_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
 # Create a user_loader callbackqe
 @login_manager.user_loader
 def load_user(user_id):
-    return db.get_or_404(UserAccts, user_id)
+    # Flask-Login expects None for an unknown user id.
+    return db.session.get(UserAccts, int(user_id))
 
 
 # Create an admin_only decorator
@@ -55,10 +108,39 @@ class Base(DeclarativeBase):
 
 
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///posts.db'
+# Size the engine's connection pool for the request threads, so open connections (with the PRAGMAs below already
+# applied) get reused. timeout is how long a writer waits on SQLite's lock.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'connect_args': {'check_same_thread': False, 'timeout': 30},
+}
 db = SQLAlchemy(model_class=Base)
 db.init_app(app)
 
 
+# Tune every new SQLite connection: WAL so readers don't block the writer and a commit is one appended
+# WAL frame, synchronous=NORMAL (safe with WAL), a 256MB mmap, a ~20MB page cache and in-memory temp tables.
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+# In development, flag N+1 lazy loads (e.g. post.author inside a template loop) as they happen.
+# nplusone is a dev-only tool (pip install -r requirements-dev.txt), so it is only used in debug mode, and only
+# when it is installed.
+if get_debug_flag() and importlib.util.find_spec("nplusone"):
+    from nplusone.ext.flask_sqlalchemy import NPlusOne
+    NPlusOne(app)
+
+
 # CONFIGURE TABLES
 class BlogPost(db.Model):
     __tablename__ = "blog_posts"
@@ -69,19 +151,29 @@ class BlogPost(db.Model):
     author = relationship("UserAccts", back_populates="posts")
     title: Mapped[str] = mapped_column(String(250), unique=True, nullable=False)
     subtitle: Mapped[str] = mapped_column(String(250), nullable=False)
-    date: Mapped[str] = mapped_column(String(250), nullable=False)
+    # Stored as a real DATE (formatted in the templates) so it can be sorted and range-scanned through the index.
+    # Annotated as dt.date because the column's own name shadows "date" inside the class body.
+    date: Mapped[dt.date] = mapped_column(Date, nullable=False, index=True)
     body: Mapped[str] = mapped_column(Text, nullable=False)
     img_url: Mapped[str] = mapped_column(String(250), nullable=False)
+    # Set on every change to the post or its comments. Part of the cache key for the rendered post, see _render_post.
+    # Indexed so the index page's MAX(updated_at) ETag check is a single index seek.
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True, default=datetime.utcnow,
+                                                 onupdate=datetime.utcnow)
     # "comment_author" refers to the comment_author property in the Comment class.
-    comments = relationship("Comment", back_populates="parent_post")
+    # Comments are deleted along with their post.
+    comments = relationship("Comment", back_populates="parent_post", cascade="all, delete-orphan")
 
 
 # TODO: Create a User table for all your registered users.
 class UserAccts(UserMixin, db.Model):
     __tablename__ = "user_accts"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    email: Mapped[str] = mapped_column(String(250), unique=True, nullable=False)
-    password: Mapped[str] = mapped_column(String(250), nullable=False)
+    # 320 characters is the longest address RFC 5321 allows.
+    email: Mapped[str] = mapped_column(String(320), unique=True, nullable=False)
+    # Sized to hold the full encoded Argon2 hash string. Deferred, so loading a user (e.g. in load_user on every
+    # request) skips the hash. Only login needs it and undefers it explicitly.
+    password: Mapped[str] = mapped_column(String(512), nullable=False, deferred=True)
     name: Mapped[str] = mapped_column(String(1000), nullable=False)
     # This will act like a List of BlogPost objects attached to each User.
     # The "author" refers to the author property in the BlogPost class.
@@ -90,6 +182,11 @@ class UserAccts(UserMixin, db.Model):
     comments = relationship("Comment", back_populates="comment_author")
 
 
+# Unique functional index: emails are case-insensitive, so the schema itself rejects "A@x.com" next to "a@x.com",
+# and the lower(email) lookups in login and register are index scans.
+db.Index('ix_user_email_lower', db.func.lower(UserAccts.email), unique=True)
+
+
 class Comment(db.Model):
     __tablename__ = "comments"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -104,18 +201,38 @@ class Comment(db.Model):
     text: Mapped[str] = mapped_column(Text, nullable=False)
 
 
+# create_all() only creates missing tables. A posts.db made by an older version of the app must be upgraded once
+# with "python upgrade_db.py" (or deleted and recreated), otherwise queries fail with "no such column".
 with app.app_context():
     db.create_all()
 
 
-# TODO: Use Werkzeug to hash the user's password when creating a new user.
+# Check a password against a stored hash. Accounts created before the switch to Argon2 still have
+# Werkzeug PBKDF2 hashes ("pbkdf2:sha256:..."), so those are checked with Werkzeug instead.
+def verify_password(pwhash, password):
+    if pwhash.startswith("pbkdf2:"):
+        return check_password_hash(pwhash=pwhash, password=password)
+    try:
+        return ph.verify(pwhash, password)
+    # VerificationError covers a wrong password (VerifyMismatchError), InvalidHashError a stored value that
+    # isn't a valid hash at all. Either way the login fails rather than erroring.
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+# Legacy PBKDF2 hashes and Argon2 hashes made with old parameters get re-hashed on a successful login.
+def needs_rehash(pwhash):
+    return pwhash.startswith("pbkdf2:") or ph.check_needs_rehash(pwhash)
+
+
+# Hash the user's password with Argon2id when creating a new user.
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     r_form = RegisterForm()
     if r_form.validate_on_submit():
         #Check is users email already exists in the DB
-        email = r_form.email.data
-        result = db.session.execute(db.select(UserAccts).where(UserAccts.email == email))
+        email = r_form.email.data.lower().strip()
+        result = db.session.execute(db.select(UserAccts).where(db.func.lower(UserAccts.email) == email))
         # Note, email in db is unique so will only have one result.
         user = result.scalar()
         if user:
@@ -123,10 +240,10 @@ def register():
             flash("You've already signed up with that email, log in instead!")
             return redirect(url_for('login'))
 
-        hash_pass = generate_password_hash(password=r_form.password.data, method='pbkdf2:sha256', salt_length=8)
+        hash_pass = ph.hash(r_form.password.data)
         new_user = UserAccts(
             name=r_form.name.data,
-            email=r_form.email.data,
+            email=email,
             password=hash_pass,
         )
         db.session.add(new_user)
@@ -144,23 +261,28 @@ def login():
     l_form = LoginForm()
     if l_form.validate_on_submit():
         # Retrieve the data entered by the user
-        u_email = l_form.email.data
+        u_email = l_form.email.data.lower().strip()
         u_password = l_form.password.data
 
         # Construct a query to select from the database. Returns the rows in the database to the 'results' variable
         # use the .scalars() and .all() method to take the elements inside the DB row and add them to a python list
         # named 'u_acct'
-        result = db.session.execute(db.select(UserAccts).where(UserAccts.email == u_email))
+        result = db.session.execute(db.select(UserAccts).options(undefer(UserAccts.password))
+                                    .where(db.func.lower(UserAccts.email) == u_email))
         u_acct = result.scalar()
 
         # Email doesn't exist or password incorrect.
         if not u_acct:
             flash("That email does not exist, please try again.")
             return redirect(url_for('login'))
-        elif not check_password_hash(pwhash=u_acct.password, password=u_password):
+        elif not _HASH_POOL.submit(verify_password, u_acct.password, u_password).result():
             flash('Password incorrect, please try again.')
             return redirect(url_for('login'))
         else:
+            # Lazily migrate the stored hash now that we have the plain text password.
+            if needs_rehash(u_acct.password):
+                u_acct.password = ph.hash(u_password)
+                db.session.commit()
             login_user(u_acct)
             return redirect(url_for('get_all_posts'))
     return render_template("login.html", form=l_form)
@@ -172,31 +294,111 @@ def logout():
     return redirect(url_for('get_all_posts'))
 
 
+# Weak ETag for a page built from the given values.
+def _etag_for(*parts):
+    return hashlib.md5("-".join(str(part) for part in parts).encode()).hexdigest()
+
+
+# Check the request's If-None-Match against an ETag. Flask-Compress appends the encoding to the ETags it
+# sends (e.g. "<etag>:br"), so only the part before any ":" is compared.
+def _not_modified(etag):
+    return any(tag.split(':')[0] == etag for tag in request.if_none_match.as_set(include_weak=True))
+
+
+def _not_modified_response(etag):
+    response = make_response("", 304)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+POSTS_PER_PAGE = 20
+
+
 @app.route('/')
 def get_all_posts():
-    result = db.session.execute(db.select(BlogPost))
-    posts = result.scalars().all()
-    return render_template("index.html", all_posts=posts)
+    # Keyset pagination: show the newest POSTS_PER_PAGE posts older than ?cursor=<post id>.
+    # Ordering and filtering on the primary key keeps this an index scan, unlike OFFSET.
+    cursor = request.args.get('cursor', type=int)
+    # The page only changes when a post is added, edited or deleted, or for a different viewer (the admin
+    # gets delete buttons), so answer repeat visits with a 304 before running the posts query or the template.
+    # Separate scalar subqueries, so SQLite answers MAX() with one seek on ix_blog_posts_updated_at (combined with
+    # count() in one SELECT it scans instead). count() still walks a narrow covering index rather than the table,
+    # it is what notices a deleted post.
+    post_count, last_update = db.session.execute(db.select(
+        db.select(db.func.count()).select_from(BlogPost).scalar_subquery(),
+        db.select(db.func.max(BlogPost.updated_at)).scalar_subquery(),
+    )).one()
+    etag = _etag_for(post_count, last_update, cursor, current_user.get_id())
+    if _not_modified(etag):
+        return _not_modified_response(etag)
+    # Load each post's author in the same JOINed query, since index.html shows post.author.name for every post.
+    stmt = db.select(BlogPost).options(joinedload(BlogPost.author))
+    if cursor:
+        stmt = stmt.where(BlogPost.id < cursor)
+    # One post more than a page, so the template can tell whether there is an older page to link to.
+    stmt = stmt.order_by(BlogPost.id.desc()).limit(POSTS_PER_PAGE + 1)
+    # Fetch the rows in batches and stream the page, so neither the posts nor the HTML are built up in memory.
+    posts = db.session.execute(stmt.execution_options(yield_per=POSTS_PER_PAGE + 1)).scalars()
+    response = make_response(stream_template("index.html", all_posts=posts, page_size=POSTS_PER_PAGE))
+    response.set_etag(etag, weak=True)
+    if not current_user.is_authenticated:
+        response.headers['Cache-Control'] = 'public, max-age=60, stale-while-revalidate=300'
+    return response
+
+
+# Render the parts of a post page that are the same for every visitor: the header and body, and the comment list,
+# plus an ETag for the two. Cached per post, keyed on updated_at so an edit automatically misses the old entry.
+@cache.memoize(timeout=3600)
+def _render_post(post_id, updated_at):
+    # Load the post with its author, then all its comments (and their authors) in one batched query,
+    # instead of a lazy SELECT per comment author while the templates render.
+    post = db.one_or_404(
+        db.select(BlogPost)
+        .options(joinedload(BlogPost.author),
+                 selectinload(BlogPost.comments).joinedload(Comment.comment_author))
+        .where(BlogPost.id == post_id)
+    )
+    post_html = render_template("post-content.html", post=post)
+    comments_html = render_template("post-comments.html", post=post)
+    return post_html, comments_html, _etag_for(post_html, comments_html)
 
 
 # TODO: Allow logged-in users to comment on posts
 @app.route("/post/<int:post_id>", methods=["GET", "POST"])
 def show_post(post_id):
-    requested_post = db.get_or_404(BlogPost, post_id)
     com_form = CommentForm()
     if com_form.validate_on_submit():
         if not current_user.is_authenticated:
             flash('You need to Login or register to comment')
             return redirect(url_for("login"))
 
+        requested_post = db.get_or_404(BlogPost, post_id)
         new_comment = Comment(
             text=com_form.comment_text.data,
             comment_author=current_user,
             parent_post=requested_post,
         )
+        # The cached comment list no longer includes every comment. Bumping updated_at changes the cache key,
+        # so every worker process renders the post again, and this one drops its old entry straight away.
+        old_updated_at = requested_post.updated_at
+        requested_post.updated_at = datetime.utcnow()
         db.session.add(new_comment)
         db.session.commit()
-    return render_template("post.html", post=requested_post, c_form=com_form)
+        cache.delete_memoized(_render_post, post_id, old_updated_at)
+
+    # The cache key is read from the database on every view, so an edit made in any worker process is seen here.
+    updated_at = db.one_or_404(db.select(BlogPost.updated_at).where(BlogPost.id == post_id))
+    post_html, comments_html, fragments_etag = _render_post(post_id, updated_at)
+    # Besides the post and comments the page depends on the viewer (the admin gets an edit button) and holds a
+    # CSRF token that expires after an hour. Rotating the ETag every 30 minutes means a page revalidated from
+    # the browser cache never carries an expired token.
+    etag = _etag_for(fragments_etag, current_user.get_id(), int(time.time() // 1800))
+    if request.method == "GET" and _not_modified(etag):
+        return _not_modified_response(etag)
+    response = make_response(render_template("post.html", post_id=post_id, post_html=post_html,
+                                              comments_html=comments_html, c_form=com_form))
+    response.set_etag(etag, weak=True)
+    return response
 
 
 # TODO: Use a decorator so only an admin user can create a new post
@@ -211,7 +413,7 @@ def add_new_post():
             body=form.body.data,
             img_url=form.img_url.data,
             author=current_user,
-            date=date.today().strftime("%B %d, %Y")
+            date=date.today()
         )
         db.session.add(new_post)
         db.session.commit()
@@ -223,7 +425,8 @@ def add_new_post():
 @app.route("/edit-post/<int:post_id>", methods=["GET", "POST"])
 @admin_only
 def edit_post(post_id):
-    post = db.get_or_404(BlogPost, post_id)
+    # The form below is filled in with post.author, so load the author in the same query.
+    post = db.one_or_404(db.select(BlogPost).options(joinedload(BlogPost.author)).where(BlogPost.id == post_id))
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -233,6 +436,8 @@ def edit_post(post_id):
     )
 
     if edit_form.validate_on_submit():
+        # Drop the cached render of the old version, updated_at changes on commit.
+        cache.delete_memoized(_render_post, post.id, post.updated_at)
         post.title = edit_form.title.data
         post.subtitle = edit_form.subtitle.data
         post.img_url = edit_form.img_url.data
@@ -245,8 +450,10 @@ def edit_post(post_id):
 
 # TODO: Use a decorator so only an admin user can delete a post
 @app.route("/delete/<int:post_id>")
+@admin_only
 def delete_post(post_id):
     post_to_delete = db.get_or_404(BlogPost, post_id)
+    cache.delete_memoized(_render_post, post_to_delete.id, post_to_delete.updated_at)
     db.session.delete(post_to_delete)
     db.session.commit()
     return redirect(url_for('get_all_posts'))
@@ -262,11 +469,73 @@ def contact():
     return render_template("contact.html")
 
 
+# The current year only needs working out once an hour, keyed on the hour since the epoch.
+@lru_cache(maxsize=1)
+def _year_for(hour):
+    return date.today().year
+
+
 #Inject a new variable named 'year' automatically into the context of all templates in the app
 #to display the current year on the footer of each webpage.
 @app.context_processor
 def inject_year():
-    return dict(year=date.today().year)
+    return dict(year=_year_for(time.time() // 3600))
+
+
+# Bulk load posts from a JSON file (a list of objects with title, subtitle, body and img_url), e.g. for seeding
+# a demo blog: flask --app main import-posts posts.json
+# All rows go in with one executemany INSERT and a single commit, instead of an ORM add/commit per post.
+@app.cli.command("import-posts")
+@click.argument("json_file", type=click.File())
+@click.option("--author-id", default=1, help="Id of the user the posts are credited to (defaults to the admin).")
+def import_posts(json_file, author_id):
+    if db.session.get(UserAccts, author_id) is None:
+        raise click.UsageError(f"There is no user with id {author_id}, register one or pass --author-id.")
+    try:
+        posts = json.load(json_file)
+    except json.JSONDecodeError as e:
+        raise click.ClickException(f"{json_file.name} is not valid JSON: {e}")
+    if not isinstance(posts, list):
+        raise click.ClickException(f"{json_file.name} must contain a list of posts.")
+
+    fields = ("title", "subtitle", "body", "img_url")
+    post_date = date.today()
+    rows = []
+    for number, post in enumerate(posts, start=1):
+        missing = [field for field in fields if not isinstance(post, dict) or field not in post]
+        if missing:
+            raise click.ClickException(f"Post {number} is missing: {', '.join(missing)}.")
+        rows.append(dict({field: post[field] for field in fields}, author_id=author_id, date=post_date))
+
+    titles = [row["title"] for row in rows]
+    if len(set(titles)) != len(titles):
+        raise click.ClickException("The file contains the same title more than once, post titles must be unique.")
+    existing = db.session.execute(db.select(BlogPost.title).where(BlogPost.title.in_(titles))).scalars().all()
+    if existing:
+        raise click.ClickException(f"These titles are already in use: {', '.join(existing)}.")
+
+    if rows:
+        try:
+            db.session.execute(db.insert(BlogPost), rows)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            raise click.ClickException(f"Nothing was imported: {e.orig}")
+    click.echo(f"Imported {len(rows)} posts.")
+
+
+# Compile every HTML template (ours and the extensions') when the worker starts, rather than on the first
+# request that uses it. Runs last so filters like gravatar are registered before the templates compile.
+with app.app_context():
+    for template_name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(template_name)
+
+# Likewise build each form class's field list (WTForms does this on a class's first instantiation) at startup.
+# CSRF is off for this throwaway instance so startup doesn't need a session or SECRET_KEY.
+# The forms themselves are still created per request, since each one carries the visitor's own CSRF token.
+with app.test_request_context():
+    for form_class in (CreatePostForm, RegisterForm, LoginForm, CommentForm):
+        form_class(meta={"csrf": False})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+# Upgrade a posts.db created by an older version of the app to the current schema.
+# db.create_all() in main.py only creates missing tables, it never alters existing ones, so an old database has to be
+# upgraded once (or deleted and recreated) before running the app:
+#
+#     python upgrade_db.py [path/to/posts.db]      (defaults to instance/posts.db)
+#
+# It adds blog_posts.updated_at, converts blog_posts.date from "October 14, 2026" style text to a DATE and creates
+# the new indexes (user_accts is rebuilt too, for its widened email and password columns). Tables and indexes are
+# generated from the models in main.py, so an upgraded database matches one made by create_all(). Importing main
+# also runs its create_all() on instance/posts.db. Running it again on an upgraded database does nothing.
+from datetime import datetime
+import sqlite3
+import sys
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateIndex, CreateTable
+from main import BlogPost, UserAccts
+
+
+# Old posts stored the date already formatted with "%B %d, %Y". SQLAlchemy keeps a SQLite DATE as "YYYY-MM-DD".
+def convert_date(old_date):
+    try:
+        return datetime.strptime(old_date, "%B %d, %Y").date().isoformat()
+    except ValueError:
+        # Already a DATE string.
+        return datetime.strptime(old_date, "%Y-%m-%d").date().isoformat()
+
+
+def compile_ddl(element):
+    return str(element.compile(dialect=sqlite.dialect()))
+
+
+# (name, declared type, NOT NULL) for each column, as PRAGMA table_info reports them.
+def current_columns(connection, table_name):
+    return [(name, col_type, bool(notnull))
+            for _, name, col_type, notnull, _, _ in connection.execute(f"PRAGMA table_info({table_name})")]
+
+
+def model_columns(table):
+    return [(column.name, column.type.compile(dialect=sqlite.dialect()), not column.nullable)
+            for column in table.columns]
+
+
+# Value for a column of the new table, from the old row (a dict of the old table's columns).
+def upgraded_value(table_name, column_name, old_row, now):
+    if table_name == "blog_posts" and column_name == "updated_at" and column_name not in old_row:
+        return now
+    if table_name == "blog_posts" and column_name == "date":
+        return convert_date(old_row["date"])
+    return old_row[column_name]
+
+
+# SQLite can't change a column's type or constraints in place, so rebuild any table whose columns differ from the
+# model: create it from the model's own DDL, copy every row (keeping the ids) and swap it in.
+def upgrade_table(connection, table):
+    if current_columns(connection, table.name) == model_columns(table):
+        return
+    new_name = f"{table.name}_new"
+    connection.execute(compile_ddl(CreateTable(table)).replace(
+        f"CREATE TABLE {table.name} ", f"CREATE TABLE {new_name} ", 1))
+    cursor = connection.execute(f"SELECT * FROM {table.name}")
+    old_names = [description[0] for description in cursor.description]
+    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
+    names = [column.name for column in table.columns]
+    rows = [[upgraded_value(table.name, name, dict(zip(old_names, old_row)), now) for name in names]
+            for old_row in cursor.fetchall()]
+    connection.executemany(f"INSERT INTO {new_name} ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})",
+                           rows)
+    connection.execute(f"DROP TABLE {table.name}")
+    connection.execute(f"ALTER TABLE {new_name} RENAME TO {table.name}")
+    print(f"Upgraded {table.name} ({len(rows)} rows).")
+
+
+def create_indexes(connection):
+    duplicates = connection.execute(
+        "SELECT lower(email) FROM user_accts GROUP BY lower(email) HAVING count(*) > 1").fetchall()
+    if duplicates:
+        sys.exit("These emails are registered more than once with different capitalisation, merge or remove the "
+                 "extra accounts first: " + ", ".join(email for email, in duplicates))
+    for table in (BlogPost.__table__, UserAccts.__table__):
+        for index in table.indexes:
+            connection.execute(compile_ddl(CreateIndex(index, if_not_exists=True)))
+
+
+def main():
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "instance/posts.db"
+    # Manage the transaction explicitly so the table rebuild (DDL included) either fully happens or not at all.
+    connection = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        connection.execute("BEGIN")
+        for table in (BlogPost.__table__, UserAccts.__table__):
+            upgrade_table(connection, table)
+        create_indexes(connection)
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+    print(f"{db_path} is up to date.")
+
+
+if __name__ == "__main__":
+    main()